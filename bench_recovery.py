@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# lock_timer_2.py reads cn_monitor.conf on import, so run from a scratch directory
+# holding a dummy config and import it from this script's directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+WORK_DIR = tempfile.mkdtemp(prefix="bench_recovery_")
+with open(os.path.join(WORK_DIR, "cn_monitor.conf"), "w") as file:
+    file.write(
+        "[CLUSTER]\nTOKEN = bench\nCLUSTER_ADDRESS = localhost\nUSE_SSL = False\n"
+    )
+os.chdir(WORK_DIR)
+sys.path.insert(0, SCRIPT_DIR)
+
+import lock_timer_2  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Time startup catch-up on persisted pending WORM locks"
+)
+parser.add_argument("--count", type=int, default=1_000_000, help="Pending locks to persist")
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=lock_timer_2.RECOVERY_CONCURRENCY,
+    help="Overdue locks fired at once",
+)
+parser.add_argument(
+    "--fail-every",
+    type=int,
+    default=0,
+    help="Make every Nth lock call fail, to check failed locks stay persisted",
+)
+args = parser.parse_args()
+
+
+lock_calls = 0
+
+
+# Stand-in for the cluster API call so only recovery overhead is measured
+async def fake_lock_file(path, HOLD_TIMER):
+    global lock_calls
+    lock_calls += 1
+    failed = args.fail_every and lock_calls % args.fail_every == 0
+    await asyncio.sleep(0)
+    return not failed
+
+
+# Track the longest gap between loop ticks, which is how long event handling would stall
+async def measure_loop_stalls(stalls):
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.01)
+        now = time.perf_counter()
+        stalls.append(now - last - 0.01)
+        last = now
+
+
+# Write args.count overdue pending locks straight to a fresh store
+def populate(db_path):
+    conn = lock_timer_2.open_pending_db(db_path)
+    due = time.time() - lock_timer_2.GRACE_PERIOD
+    with conn:
+        conn.executemany(
+            "INSERT INTO pending_locks (path, due) VALUES (?, ?)",
+            ((f"Engineering/dropbox/file_{i}", due) for i in range(args.count)),
+        )
+    conn.close()
+
+
+async def main():
+    db_path = os.path.join(WORK_DIR, lock_timer_2.PENDING_DB)
+    start = time.perf_counter()
+    populate(db_path)
+    print(f"Persisted {args.count} pending locks in {time.perf_counter() - start:.2f}s")
+
+    lock_timer_2.lock_file = fake_lock_file
+    lock_timer_2.RECOVERY_CONCURRENCY = args.concurrency
+    # Failures are what is being measured, so do not back off on them
+    lock_timer_2.RETRY_DELAY = 0
+
+    stalls = []
+    monitor = asyncio.create_task(measure_loop_stalls(stalls))
+    flusher = asyncio.create_task(lock_timer_2.flush_pending_locks())
+
+    start = time.perf_counter()
+    lock_timer_2.db = lock_timer_2.open_pending_db(db_path)
+    swept = await lock_timer_2.sweep_pending_locks()
+    caught_up = time.perf_counter() - start
+    await lock_timer_2.flush_pending_writes()
+    flushed = time.perf_counter() - start
+    monitor.cancel()
+    flusher.cancel()
+
+    remaining = lock_timer_2.db.execute("SELECT COUNT(*) FROM pending_locks").fetchone()[0]
+    expected = args.count // args.fail_every if args.fail_every else 0
+    print(f"Startup to caught up: {caught_up:.2f}s ({swept / caught_up:,.0f} locks/s)")
+    print(f"Including flush of completed locks: {flushed:.2f}s, {remaining} left pending")
+    print(f"Longest event loop stall: {max(stalls, default=0) * 1000:.0f}ms")
+    assert remaining == expected, f"expected {expected} failed locks to stay pending"
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        if lock_timer_2.db is not None:
+            lock_timer_2.db.close()
+        os.chdir(SCRIPT_DIR)
+        shutil.rmtree(WORK_DIR)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import random
+import time
+
+from storm_detector import OVERFLOW_EXT, StormDetector, subtree_keys
+
+parser = argparse.ArgumentParser(
+    description="Replay a synthetic encryption storm trace through StormDetector"
+)
+parser.add_argument("--background-rate", type=int, default=200, help="Normal events per second")
+parser.add_argument("--storm-rate", type=int, default=2000, help="Storm renames per second")
+parser.add_argument("--storm-start", type=float, default=60, help="Trace second the storm starts")
+parser.add_argument("--duration", type=float, default=120, help="Trace length in seconds")
+parser.add_argument("--window", type=float, default=10, help="Detector window in seconds")
+parser.add_argument("--rename-threshold", type=int, default=1000)
+parser.add_argument("--delete-threshold", type=int, default=1000)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+FOLDER = "Engineering/dropbox"
+EXTENSIONS = [".docx", ".xlsx", ".pdf", ".jpg", ".txt", ".dwg"]
+
+
+# Build (timestamp, kind, old_path, new_path) events: ordinary saves, renames and deletes
+# throughout, plus an encryption storm appending .locked to every file after storm_start
+def build_trace(rng):
+    trace = []
+    for i in range(int(args.duration * args.background_rate)):
+        now = i / args.background_rate
+        ext = rng.choice(EXTENSIONS)
+        path = f"{FOLDER}/user/file_{i}{ext}"
+        match rng.random():
+            case r if r < 0.15:
+                # Editors save by writing a temp file and renaming it over the original
+                trace.append((now, "rename", f"{FOLDER}/user/~tmp_{i}.tmp", path))
+            case r if r < 0.3:
+                trace.append((now, "rename", path, f"{FOLDER}/user/renamed_{i}{ext}"))
+            case r if r < 0.6:
+                trace.append((now, "delete", path, None))
+    storm_events = int((args.duration - args.storm_start) * args.storm_rate)
+    for i in range(storm_events):
+        now = args.storm_start + i / args.storm_rate
+        path = f"{FOLDER}/share/doc_{i}{rng.choice(EXTENSIONS)}"
+        trace.append((now, "rename", path, path + ".locked"))
+    trace.sort(key=lambda event: event[0])
+    return trace
+
+
+# A detector that never fires, for checking the window counters on their own
+def quiet_detector(**kwargs):
+    never = 10**9
+    return StormDetector(
+        rename_threshold=never, delete_threshold=never, min_renames=never, **kwargs
+    )
+
+
+def check_window():
+    # Buckets fall out of the window one at a time, and all at once after a long gap
+    detector = quiet_detector(window=10, buckets=10)
+    for _ in range(5):
+        detector.record_delete("s", now=0.5)
+    for _ in range(3):
+        detector.record_delete("s", now=5.5)
+    window = detector.subtrees["s"]
+    assert window.total_deletes == 8
+    detector.record_delete("s", now=10.5)
+    assert window.total_deletes == 4, window.total_deletes
+    detector.record_delete("s", now=100)
+    assert window.total_deletes == 1, window.total_deletes
+
+    # Late events land in the newest bucket and expire with it
+    detector.record_delete("s", now=50)
+    assert window.total_deletes == 2, window.total_deletes
+    detector.record_delete("s", now=110.5)
+    assert window.total_deletes == 1, window.total_deletes
+
+
+def check_extensions(rng):
+    # New extensions beyond max_extensions share one overflow key
+    detector = quiet_detector(max_extensions=3)
+    for i in range(5):
+        detector.record_rename("s", f"a/f{i}.txt", f"a/f{i}.e{i}", now=0)
+    window = detector.subtrees["s"]
+    assert len(window.ext_totals) == 4 and window.ext_totals[OVERFLOW_EXT] == 2
+
+    # The running entropy matches a direct computation, including after expiry
+    detector = quiet_detector(window=10, buckets=10)
+    for i in range(2000):
+        now = i / 100
+        new_ext = rng.choice([".a", ".b", ".b", ".c", ".locked", ".locked", ".locked"])
+        detector.record_rename("s", f"a/f{i}.txt", f"a/f{i}{new_ext}", now=now)
+        window = detector.subtrees["s"]
+        if i % 97 == 0:
+            total = sum(window.ext_totals.values())
+            direct = -sum(c / total * math.log2(c / total) for c in window.ext_totals.values())
+            assert abs(window.ext_entropy() - direct) < 1e-9, (window.ext_entropy(), direct)
+
+
+def check_subtrees(rng):
+    assert subtree_keys(FOLDER, f"{FOLDER}/a.txt") == [FOLDER]
+    assert subtree_keys(FOLDER, f"{FOLDER}/share/x/a.txt") == [FOLDER, f"{FOLDER}/share"]
+
+    # The least recently active subtree is dropped once max_subtrees are tracked
+    detector = quiet_detector(max_subtrees=2)
+    for subtree in ["a", "b", "a", "c"]:
+        detector.record_delete(subtree, now=0)
+    assert list(detector.subtrees) == ["a", "c"], list(detector.subtrees)
+
+    # A burst of extension changes in one subdirectory is diluted by same extension
+    # renames across the folder, but still fires on the subdirectory's own counters
+    detector = StormDetector()
+    fired = set()
+    for i in range(900):
+        now = i / 100
+        if i % 6:
+            old, new = f"{FOLDER}/user/f{i}.txt", f"{FOLDER}/user/g{i}.txt"
+        else:
+            old = f"{FOLDER}/share/f{i}.txt"
+            new = f"{FOLDER}/share/f{i}{rng.choice(EXTENSIONS)}{i % 7}"
+        for subtree in subtree_keys(FOLDER, new):
+            if detector.record_rename(subtree, old, new, now):
+                fired.add(subtree)
+    assert fired == {f"{FOLDER}/share"}, fired
+
+
+def check_debounce():
+    # A storm fires once per window, then again if it is still going
+    detector = StormDetector(window=10, delete_threshold=5)
+    fired = [now for now in range(30) if detector.record_delete("s", now=now / 2)]
+    assert fired == [4, 24], fired
+
+
+# Saving through a temp file changes the extension on every rename, which must not
+# look like encryption, while the same traffic without the temp names does fire
+def check_temp_saves(rate=90, duration=60):
+    saves = [
+        (i / rate, f"{FOLDER}/user/~WRL{i}.tmp", f"{FOLDER}/user/file_{i}.docx")
+        for i in range(duration * rate)
+    ]
+    detector = StormDetector()
+    fired = [now for now, old, new in saves if detector.record_rename(FOLDER, old, new, now)]
+    assert not fired, fired
+    detector = StormDetector(temp_extensions=())
+    fired = [
+        now
+        for now, old, new in saves
+        if detector.record_rename(FOLDER, old.replace("~", ""), new, now)
+    ]
+    assert fired, "temp save trace should fire without the temp file exclusion"
+    print(f"Temp file saves at {rate}/s for {duration}s: no detections")
+
+
+def main():
+    check_window()
+    check_extensions(random.Random(args.seed))
+    check_subtrees(random.Random(args.seed))
+    check_debounce()
+    check_temp_saves()
+    print("Detector self-checks passed")
+
+    trace = build_trace(random.Random(args.seed))
+    detector = StormDetector(
+        window=args.window,
+        rename_threshold=args.rename_threshold,
+        delete_threshold=args.delete_threshold,
+    )
+
+    detections = []
+    start = time.perf_counter()
+    for count, (now, kind, old_path, new_path) in enumerate(trace, 1):
+        for subtree in subtree_keys(FOLDER, old_path):
+            if kind == "rename":
+                reason = detector.record_rename(subtree, old_path, new_path, now)
+            else:
+                reason = detector.record_delete(subtree, now)
+            if reason:
+                detections.append((now, count, f"{subtree}: {reason}"))
+    elapsed = time.perf_counter() - start
+
+    print(f"Replayed {len(trace)} events in {elapsed:.2f}s ({len(trace) / elapsed:,.0f} events/s)")
+    false_alarms = [d for d in detections if d[0] < args.storm_start]
+    print(f"False alarms before the storm: {len(false_alarms)}")
+    storm_detections = [d for d in detections if d[0] >= args.storm_start]
+    if not storm_detections:
+        print("Storm was not detected")
+        return
+    now, count, reason = storm_detections[0]
+    storm_renames = int((now - args.storm_start) * args.storm_rate) + 1
+    print(
+        f"Time to detect: {now - args.storm_start:.3f}s of trace time, "
+        f"after {storm_renames} storm renames (event {count} of the trace)"
+    )
+    print(f"Reason: {reason}")
+    window = detector.subtrees[FOLDER]
+    print(f"Extensions tracked at end of trace: {len(window.ext_totals)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@
 import asyncio
 import configparser
 import json
+import sqlite3
+import time
 import urllib
 from datetime import datetime, timedelta
 
@@ -10,6 +12,8 @@ import urllib3
 import uvloop
 from transitions import Machine, MachineError
 
+from storm_detector import StormDetector, subtree_keys
+
 # Load the config file
 config = configparser.ConfigParser()
 config.read("cn_monitor.conf")
@@ -42,9 +46,79 @@ HOLD_TIMER = 60
 # How long until lock is applied in seconds
 GRACE_PERIOD = 5
 
+# Local SQLite file where pending locks are persisted so they survive a restart
+PENDING_DB = "pending_locks.db"
+
+# How often in seconds pending lock changes are flushed to PENDING_DB.
+# Keep this well under GRACE_PERIOD so a crash loses as little as possible
+FLUSH_INTERVAL = 1
+
+# Maximum number of persisted locks being waited on or fired at once by a sweep
+RECOVERY_CONCURRENCY = 64
+
+# How often in seconds PENDING_DB is swept for locks that failed and need a retry
+RETRY_INTERVAL = 60
+
+# How long in seconds a sweep worker backs off after a failed lock, so a busy
+# cluster answering 429/503 is not hammered while catching up
+RETRY_DELAY = 5
+
+# Failed attempts after which a persisted lock is dropped with an error, so locks that
+# can never succeed do not pile up in PENDING_DB (about an hour at RETRY_INTERVAL)
+MAX_LOCK_ATTEMPTS = 60
+
+# Statuses worth retrying; any other 4xx means the cluster will never accept this lock
+RETRYABLE_STATUSES = {401, 408, 429}
+
+# Number of persisted locks read from PENDING_DB per query while sweeping
+SWEEP_CHUNK = 1000
+
+# Length of the sliding window in seconds for rename/delete storm detection
+STORM_WINDOW = 10
+
+# Storm counters are kept per watched folder and per subdirectory directly below it.
+# Renames or deletes within STORM_WINDOW in one of those that count as a storm
+STORM_RENAME_THRESHOLD = 1000
+STORM_DELETE_THRESHOLD = 1000
+
+# Renames within STORM_WINDOW before the extension change ratio and entropy rules apply.
+# The entropy rule also needs this many renames that changed extension
+STORM_MIN_RENAMES = 100
+
+# Ratio rule: share of renames changing the file extension that counts as a storm
+STORM_EXT_CHANGE_RATIO = 0.8
+
+# Entropy rule: entropy in bits of the new extensions at or below which renames are
+# converging on a single ransomware extension. It fires regardless of the ratio
+STORM_MAX_EXT_ENTROPY = 1.0
+
+# Most folders and subdirectories tracked at once, the least recently active is dropped
+STORM_MAX_SUBTREES = 1024
+
+# Command run when a storm is detected, the folder or subdirectory and reason are appended.
+# None only logs the detection. all_stop.py is not shipped, to use one set for example:
+# STORM_ACTION = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "all_stop.py")]
+STORM_ACTION = None
+
 # Global aiohttp ClientSession (will be initialized in main)
 session = None
 
+# Global SQLite connection to PENDING_DB (will be initialized in main).
+# It is only used from worker threads, one call at a time under db_lock
+db = None
+db_lock = asyncio.Lock()
+
+# Pending lock changes not yet flushed to PENDING_DB, keyed by path.
+# A (due time in epoch seconds, failed attempts) pair means "remember", None means "forget"
+pending_writes = {}
+
+# Paths with a lock attempt scheduled or running, so sweeps do not lock them twice
+in_flight = set()
+
+# While a sweep runs, monotonic time each path was forgotten at. Rows the sweep read
+# before that time are stale and must not be locked again (None outside a sweep)
+sweep_completed = None
+
 # This class monitors for specific fs move/rename events and could be expanded.  
 # It is not strictly needed for the file locking functions
 class FileOperation:
@@ -91,11 +165,23 @@ file_operations = {}
 move_events = {}
 
 
+# Rename/delete storm detector keyed by watched folder
+storm_detector = StormDetector(
+    window=STORM_WINDOW,
+    rename_threshold=STORM_RENAME_THRESHOLD,
+    delete_threshold=STORM_DELETE_THRESHOLD,
+    min_renames=STORM_MIN_RENAMES,
+    ext_change_ratio=STORM_EXT_CHANGE_RATIO,
+    max_ext_entropy=STORM_MAX_EXT_ENTROPY,
+    max_subtrees=STORM_MAX_SUBTREES,
+)
+
+
 def get_file_key(event):
     return f"{'_'.join(event['spine'])}"
 
 
-# File locker function
+# File locker function, returns False only when the lock should be retried
 async def lock_file(path, HOLD_TIMER):
     encoded_path = urllib.parse.quote(path, safe="")
     lock_url = (
@@ -115,20 +201,192 @@ async def lock_file(path, HOLD_TIMER):
                 print(
                     f"File {path} has been locked successfully until {retention_period} (Time now is {datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')})"
                 )
-            else:
-                print(f"Failed to lock file {path}. Status code: {response.status}")
-                response_text = await response.text()
-                print(f"Response: {response_text}")
+                return True
+            if response.status == 404:
+                # The file is gone, so there is nothing left to lock
+                print(f"File {path} no longer exists, skipping lock")
+                return True
+            print(f"Failed to lock file {path}. Status code: {response.status}")
+            response_text = await response.text()
+            print(f"Response: {response_text}")
+            if 400 <= response.status < 500 and response.status not in RETRYABLE_STATUSES:
+                print(f"Giving up on locking file {path}, the request was rejected")
+                return True
     except Exception as e:
         print(f"Error locking file {path}: {e}")
+    return False
 
-# Function to delay locking the file
-async def lock_file_after_delay(path, GRACE_PERIOD, HOLD_TIMER):
+# Function to delay locking the file, attempts counts earlier failures of this lock
+async def lock_file_after_delay(path, GRACE_PERIOD, HOLD_TIMER, attempts=0):
+    locked = False
     try:
         await asyncio.sleep(GRACE_PERIOD)
-        await lock_file(path, HOLD_TIMER)
+        locked = await lock_file(path, HOLD_TIMER)
+        if locked:
+            forget_pending_lock(path)
+        elif attempts + 1 >= MAX_LOCK_ATTEMPTS:
+            print(f"Error: dropping lock for {path} after {attempts + 1} failed attempts")
+            forget_pending_lock(path)
+        else:
+            # Keep it persisted so retry_pending_locks picks it up again
+            remember_pending_lock(path, time.time(), attempts + 1)
     except Exception as e:
         print(f"Error locking file {path} after delay: {e}")
+    finally:
+        in_flight.discard(path)
+    return locked
+
+
+# Open the pending lock store, creating it if needed
+def open_pending_db(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pending_locks "
+        "(path TEXT PRIMARY KEY, due REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+    )
+    # Stores written before failed attempts were counted lack the column
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(pending_locks)")]
+    if "attempts" not in columns:
+        conn.execute(
+            "ALTER TABLE pending_locks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+        )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS pending_locks_due ON pending_locks (due, path)"
+    )
+    conn.commit()
+    return conn
+
+
+# Queue a pending lock to be persisted on the next flush
+def remember_pending_lock(path, due, attempts=0):
+    pending_writes[path] = (due, attempts)
+
+
+# Queue a pending lock to be removed on the next flush
+def forget_pending_lock(path):
+    pending_writes[path] = None
+    if sweep_completed is not None:
+        sweep_completed[path] = time.monotonic()
+
+
+# Write a batch of pending lock changes to PENDING_DB in a single transaction
+def write_pending_batch(batch):
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO pending_locks (path, due, attempts) VALUES (?, ?, ?)",
+            [(path, *pending) for path, pending in batch.items() if pending is not None],
+        )
+        db.executemany(
+            "DELETE FROM pending_locks WHERE path = ?",
+            [(path,) for path, pending in batch.items() if pending is None],
+        )
+
+
+# Flush all queued pending lock changes, committing off the event loop
+async def flush_pending_writes():
+    global pending_writes
+    async with db_lock:
+        if not pending_writes:
+            return
+        batch, pending_writes = pending_writes, {}
+        try:
+            await asyncio.to_thread(write_pending_batch, batch)
+        except sqlite3.Error as e:
+            print(f"Error saving pending locks: {e}")
+            # Keep the batch for the next flush, newer changes win
+            batch.update(pending_writes)
+            pending_writes = batch
+
+
+# Periodically flush pending lock changes so the event path never waits on disk
+async def flush_pending_locks():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_pending_writes()
+
+
+# Read the next chunk of persisted locks in due order, after the (due, path) given.
+# Locks that failed after started are left for the next sweep, so one sweep does not
+# keep retrying them as they are saved again further along
+def read_pending_chunk(after, started):
+    return db.execute(
+        "SELECT path, due, attempts FROM pending_locks WHERE (due, path) > (?, ?) "
+        "AND (due <= ? OR attempts = 0) ORDER BY due, path LIMIT ?",
+        (*after, started, SWEEP_CHUNK),
+    ).fetchall()
+
+
+# Lock the files handed over by sweep_pending_locks, each once it is due
+async def lock_swept_files(queue):
+    while (item := await queue.get()) is not None:
+        path, due, attempts, read_at = item
+        # The row may have gone stale while queued, if the file was locked in the meantime
+        if sweep_completed.get(path, float("-inf")) >= read_at:
+            in_flight.discard(path)
+            continue
+        delay = max(0, due - time.time())
+        locked = await lock_file_after_delay(path, delay, HOLD_TIMER, attempts)
+        # A sweep reads each row once, so only completions from elsewhere need tracking
+        sweep_completed.pop(path, None)
+        if not locked:
+            await asyncio.sleep(RETRY_DELAY)
+
+
+# Stream every persisted lock not already in flight through a fixed pool of workers.
+# Rows come out in due order, so overdue locks fire first and workers sleep until
+# later ones are due, keeping memory and concurrent lock requests bounded
+async def sweep_pending_locks():
+    global sweep_completed
+    sweep_completed = {}
+    queue = asyncio.Queue(maxsize=RECOVERY_CONCURRENCY)
+    workers = [
+        asyncio.create_task(lock_swept_files(queue))
+        for _ in range(RECOVERY_CONCURRENCY)
+    ]
+    swept = 0
+    started = time.time()
+    after = (float("-inf"), "")
+    try:
+        while True:
+            async with db_lock:
+                read_at = time.monotonic()
+                rows = await asyncio.to_thread(read_pending_chunk, after, started)
+            if not rows:
+                break
+            after = rows[-1][1::-1]
+            for path, due, attempts in rows:
+                # Skip locks already being handled, and ones forgotten since this chunk
+                # was read, whether or not that has been flushed yet
+                if (
+                    path in in_flight
+                    or pending_writes.get(path, ()) is None
+                    or sweep_completed.get(path, float("-inf")) >= read_at
+                ):
+                    continue
+                in_flight.add(path)
+                swept += 1
+                await queue.put((path, due, attempts, read_at))
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        sweep_completed = None
+    return swept
+
+
+# Sweep PENDING_DB at startup to catch up on a previous run, then keep sweeping so
+# locks that failed are retried while the process runs
+async def retry_pending_locks():
+    while True:
+        try:
+            swept = await sweep_pending_locks()
+            if swept:
+                print(f"Processed {swept} persisted pending locks")
+        except Exception as e:
+            print(f"Error sweeping pending locks: {e}")
+        await asyncio.sleep(RETRY_INTERVAL)
 
 
 # Output alerts based on event or run file locker
@@ -136,7 +394,9 @@ async def alert_user(event_type, path, old_path=None):
     match event_type:
         case "child_file_added":
             print(f"New file has been added: {path}")
-            # Schedule the lock_file function to run after n seconds
+            # Persist the pending lock, then schedule the lock_file function to run after n seconds
+            remember_pending_lock(path, time.time() + GRACE_PERIOD)
+            in_flight.add(path)
             asyncio.create_task(lock_file_after_delay(path, GRACE_PERIOD, HOLD_TIMER))
         case "child_dir_added":
             print(f"New directory has been added: {path}")
@@ -148,22 +408,52 @@ async def alert_user(event_type, path, old_path=None):
             print(f"Unknown event type: {event_type} for path: {path}")
 
 
+# Feed a delete (no old_path) or a rename into the storm detector for each subtree of path
+async def check_for_storm(folder, path, old_path=None):
+    for subtree in subtree_keys(folder, path):
+        if old_path is None:
+            reason = storm_detector.record_delete(subtree)
+        else:
+            reason = storm_detector.record_rename(subtree, old_path, path)
+        if reason:
+            await trigger_storm_action(subtree, reason)
+
+
+# Run STORM_ACTION without waiting for it so event handling keeps up with the stream
+async def trigger_storm_action(folder, reason):
+    print(f"Storm detected in {folder}: {reason}")
+    if not STORM_ACTION:
+        return
+    try:
+        process = await asyncio.create_subprocess_exec(*STORM_ACTION, folder, reason)
+        print(f"Started {' '.join(STORM_ACTION)} (pid {process.pid})")
+    except Exception as e:
+        print(f"Error running storm action {STORM_ACTION}: {e}")
+
+
 # Do something with the data received from the Change Notify watcher
 async def handle_event(event_data):
     try:
         changes = json.loads(event_data)
 
         for fs_event in changes:
-            if any(
-                fs_event["path"] == folder or fs_event["path"].startswith(folder)
-                for folder in WATCHED_FOLDERS
-            ):
+            folder = next(
+                (
+                    folder
+                    for folder in WATCHED_FOLDERS
+                    if fs_event["path"] == folder or fs_event["path"].startswith(folder)
+                ),
+                None,
+            )
+            if folder is not None:
                 # print(fs_event)
                 event_type = fs_event["type"]
                 file_key = get_file_key(fs_event)
 
                 if event_type in ["child_file_added", "child_dir_added"]:
                     await alert_user(event_type, fs_event["path"])
+                elif event_type == "child_file_removed":
+                    await check_for_storm(folder, fs_event["path"])
                 elif event_type in ["child_file_moved_from", "child_dir_moved_from"]:
                     # print(f"Detected move from event: {fs_event['path']}")
                     if file_key not in file_operations:
@@ -182,6 +472,12 @@ async def handle_event(event_data):
                             move_events[file_key]["to"],
                             move_events[file_key]["from"],
                         )
+                        if event_type == "child_file_moved_to":
+                            await check_for_storm(
+                                folder,
+                                move_events[file_key]["to"],
+                                move_events[file_key]["from"],
+                            )
                         del file_operations[file_key]
                         del move_events[file_key]
             else:
@@ -213,17 +509,23 @@ async def monitor_api():
 
 
 async def main():
-    global session
+    global session, db
     if not USE_SSL:
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     session = aiohttp.ClientSession()
+    db = open_pending_db(PENDING_DB)
+
+    # Catch up on locks left pending by a previous run while monitoring resumes
+    asyncio.create_task(flush_pending_locks())
+    asyncio.create_task(retry_pending_locks())
 
     while True:
         try:
             await monitor_api()
         except KeyboardInterrupt:
             print("Quitting...")
+            await flush_pending_writes()
             await session.close()
             break
         except Exception as e:
@@ -237,7 +539,13 @@ if __name__ == "__main__":
     try:
         loop.run_until_complete(main())
     except KeyboardInterrupt:
-        loop.close()
         print("\nQuitting....")
     finally:
+        if db is not None and pending_writes:
+            # Let any flush still running in a worker thread finish before the last write
+            loop.run_until_complete(loop.shutdown_default_executor())
+            try:
+                write_pending_batch(pending_writes)
+            except sqlite3.Error as e:
+                print(f"Error saving pending locks: {e}")
         loop.close()
\ No newline at end of file
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import math
+import os
+import time
+from collections import OrderedDict
+
+# Extensions beyond max_extensions in a window are counted under this key
+OVERFLOW_EXT = "*other*"
+
+# Editors save by writing a temp file and renaming it over the original, so renames
+# from these extensions (or from ~ prefixed names) are not counted as extension changes
+TEMP_EXTENSIONS = (".tmp", ".temp", ".swp", ".part", ".crdownload")
+
+
+def xlogx(count):
+    return count * math.log2(count) if count else 0.0
+
+
+# Subtree keys an event under watched folder counts towards: the folder itself, so a storm
+# spread over many subdirectories adds up, and the subdirectory directly below it, so a
+# burst in one subdirectory is not diluted by traffic in the rest of the folder
+def subtree_keys(folder, path):
+    parts = path[len(folder):].strip("/").split("/", 1)
+    if len(parts) == 2:
+        return [folder, f"{folder}/{parts[0]}"]
+    return [folder]
+
+
+# Sliding window counters for one subtree.
+# The window is a ring of time buckets, each event touches only the current bucket and the
+# running totals, and a bucket's counts are subtracted from the totals when it expires.
+class SubtreeWindow:
+    def __init__(self, buckets, max_extensions):
+        self.buckets = buckets
+        self.max_extensions = max_extensions
+        self.current = -1  # Absolute slot number of the newest bucket
+        self.renames = [0] * buckets
+        self.ext_changes = [0] * buckets
+        self.deletes = [0] * buckets
+        self.extensions = [{} for _ in range(buckets)]
+        self.total_renames = 0
+        self.total_ext_changes = 0
+        self.total_deletes = 0
+        # New extension counts across the window and their running sum of c*log2(c),
+        # which gives the entropy without walking every extension on each event
+        self.ext_totals = {}
+        self.ext_plogp = 0.0
+
+    # Move the window forward to slot, expiring every bucket that falls out of it
+    def advance(self, slot):
+        if slot <= self.current:
+            # Late events are counted in the newest bucket
+            return self.current % self.buckets
+        for expired in range(max(self.current + 1, slot - self.buckets + 1), slot + 1):
+            self._expire(expired % self.buckets)
+        self.current = slot
+        return slot % self.buckets
+
+    def _expire(self, index):
+        self.total_renames -= self.renames[index]
+        self.total_ext_changes -= self.ext_changes[index]
+        self.total_deletes -= self.deletes[index]
+        self.renames[index] = self.ext_changes[index] = self.deletes[index] = 0
+        for ext, count in self.extensions[index].items():
+            self._adjust_ext(ext, -count)
+        self.extensions[index] = {}
+        if not self.ext_totals:
+            # Drop accumulated float error whenever the window empties
+            self.ext_plogp = 0.0
+
+    def _adjust_ext(self, ext, delta):
+        count = self.ext_totals.get(ext, 0)
+        self.ext_plogp += xlogx(count + delta) - xlogx(count)
+        if count + delta:
+            self.ext_totals[ext] = count + delta
+        else:
+            del self.ext_totals[ext]
+
+    def add_rename(self, index, new_ext=None):
+        self.renames[index] += 1
+        self.total_renames += 1
+        if new_ext is None:
+            return
+        if new_ext not in self.ext_totals and len(self.ext_totals) >= self.max_extensions:
+            new_ext = OVERFLOW_EXT
+        self.ext_changes[index] += 1
+        self.total_ext_changes += 1
+        bucket = self.extensions[index]
+        bucket[new_ext] = bucket.get(new_ext, 0) + 1
+        self._adjust_ext(new_ext, 1)
+
+    def add_delete(self, index):
+        self.deletes[index] += 1
+        self.total_deletes += 1
+
+    # Shannon entropy in bits of the new extensions seen in the window
+    def ext_entropy(self):
+        if not self.total_ext_changes:
+            return 0.0
+        return math.log2(self.total_ext_changes) - self.ext_plogp / self.total_ext_changes
+
+
+# This class watches for ransomware style rename and delete storms.
+# Callers pass a subtree key (see subtree_keys) with each event. At most max_subtrees are
+# tracked, evicting the least recently active one, so memory is bounded by max_subtrees
+# times the bucket count and max_extensions.
+# record_rename and record_delete return a reason string the first time a subtree crosses
+# a threshold, then stay quiet for one window so the action is not fired on every event.
+class StormDetector:
+    def __init__(
+        self,
+        window=10,
+        buckets=10,
+        rename_threshold=1000,
+        delete_threshold=1000,
+        min_renames=100,
+        ext_change_ratio=0.8,
+        max_ext_entropy=1.0,
+        max_extensions=256,
+        temp_extensions=TEMP_EXTENSIONS,
+        max_subtrees=1024,
+    ):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_width = window / buckets
+        self.rename_threshold = rename_threshold
+        self.delete_threshold = delete_threshold
+        # Ratio and entropy checks only apply once a window holds this many renames
+        self.min_renames = min_renames
+        self.ext_change_ratio = ext_change_ratio
+        self.max_ext_entropy = max_ext_entropy
+        self.max_extensions = max_extensions
+        self.temp_extensions = temp_extensions
+        self.max_subtrees = max_subtrees
+        self.subtrees = OrderedDict()
+        self.last_fired = {}
+
+    def _window(self, subtree, now):
+        window = self.subtrees.get(subtree)
+        if window is None:
+            if len(self.subtrees) >= self.max_subtrees:
+                evicted, _ = self.subtrees.popitem(last=False)
+                self.last_fired.pop(evicted, None)
+            window = self.subtrees[subtree] = SubtreeWindow(self.buckets, self.max_extensions)
+        else:
+            self.subtrees.move_to_end(subtree)
+        return window, window.advance(int(now // self.bucket_width))
+
+    def record_rename(self, subtree, old_path, new_path, now=None):
+        now = time.monotonic() if now is None else now
+        window, index = self._window(subtree, now)
+        old_name, old_ext = os.path.splitext(os.path.basename(old_path))
+        old_ext = old_ext.lower()
+        new_ext = os.path.splitext(new_path)[1].lower()
+        is_temp_save = old_ext in self.temp_extensions or old_name.startswith("~")
+        window.add_rename(index, new_ext if new_ext != old_ext and not is_temp_save else None)
+        return self._check(subtree, window, now)
+
+    def record_delete(self, subtree, now=None):
+        now = time.monotonic() if now is None else now
+        window, index = self._window(subtree, now)
+        window.add_delete(index)
+        return self._check(subtree, window, now)
+
+    def _check(self, subtree, window, now):
+        renames = window.total_renames
+        reason = None
+        if renames >= self.rename_threshold:
+            reason = f"{renames} renames"
+        elif window.total_deletes >= self.delete_threshold:
+            reason = f"{window.total_deletes} deletes"
+        elif renames >= self.min_renames:
+            if window.total_ext_changes / renames >= self.ext_change_ratio:
+                reason = f"{window.total_ext_changes} of {renames} renames changed extension"
+            elif (
+                window.total_ext_changes >= self.min_renames
+                and window.ext_entropy() <= self.max_ext_entropy
+            ):
+                reason = f"{window.total_ext_changes} renames converging on few new extensions"
+        if reason is None:
+            return None
+
+        last_fired = self.last_fired.get(subtree)
+        if last_fired is not None and now - last_fired < self.window:
+            return None
+        self.last_fired[subtree] = now
+        return (
+            f"{reason} within {self.window}s "
+            f"(renames: {renames}, extension changes: {window.total_ext_changes}, "
+            f"deletes: {window.total_deletes}, new extension entropy: {window.ext_entropy():.2f} bits)"
+        )